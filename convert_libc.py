@@ -1,155 +1,333 @@
 #!/usr/bin/env python3
 
-from os import open, O_RDWR, makedirs, devnull
-from os.path import abspath, exists, isfile, isdir, dirname
-from subprocess import check_call, check_output, STDOUT
+from argparse import ArgumentParser
+from atexit import register as atexit_register
+from builtins import open as open_file
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack
+from functools import partial
+from hashlib import blake2b
+from io import StringIO
+from json import dump, load
+from os import open, close, O_RDWR, makedirs, devnull, environ
+from os import getpid, replace, scandir, stat, walk
+from os.path import abspath, lexists, dirname, expanduser, join, relpath
+from shutil import copyfile, which
+from subprocess import check_output, STDOUT
 from re import compile as compile_re, M
 from sys import argv, stderr
 
+import ctypesgen_to_pxd
+
 
 # Standard headers as of POSIX.1-2008 (Base Specifications, Issue 7)
 # http://pubs.opengroup.org/onlinepubs/9699919799/
 
-_HEADERS = '''
-    aio
-    arpa/inet
-    assert
-    complex
-    cpio
-    ctype
-    dirent
-    dlfcn
-    errno
-    fcntl
-    fenv
-    float
-    fmtmsg
-    fnmatch
-    ftw
-    glob
-    grp
-    iconv
-    inttypes
-    iso646
-    langinfo
-    libgen
-    limits
-    locale
-    math
-    monetary
-    mqueue
-    ndbm
-    net/if
-    netdb
-    netinet/in
-    netinet/tcp
-    nl_types
-    poll
-    pthread
-    pwd
-    regex
-    sched
-    search
-    semaphore
-    setjmp
-    signal
-    spawn
-    stdarg
-    stdbool
-    stddef
-    stdint
-    stdio
-    stdlib
-    string
-    strings
-    stropts
-    sys/ipc
-    sys/mman
-    sys/msg
-    sys/resource
-    sys/select
-    sys/sem
-    sys/shm
-    sys/socket
-    sys/stat
-    sys/statvfs
-    sys/time
-    sys/times
-    sys/types
-    sys/uio
-    sys/un
-    sys/utsname
-    sys/wait
-    syslog
-    tar
-    termios
-    tgmath
-    time
-    trace
-    ulimit
-    unistd
-    utime
-    utmpx
-    wchar
-    wctype
-    wordexp
-
-    alloca
-    malloc
-'''.split()
-
-
-_include_pattern = compile_re(r'^ (/usr/[+\-./0-9@A-Z_a-z]+)$', M)
+_HEADERS = (
+    'aio',
+    'arpa/inet',
+    'assert',
+    'complex',
+    'cpio',
+    'ctype',
+    'dirent',
+    'dlfcn',
+    'errno',
+    'fcntl',
+    'fenv',
+    'float',
+    'fmtmsg',
+    'fnmatch',
+    'ftw',
+    'glob',
+    'grp',
+    'iconv',
+    'inttypes',
+    'iso646',
+    'langinfo',
+    'libgen',
+    'limits',
+    'locale',
+    'math',
+    'monetary',
+    'mqueue',
+    'ndbm',
+    'net/if',
+    'netdb',
+    'netinet/in',
+    'netinet/tcp',
+    'nl_types',
+    'poll',
+    'pthread',
+    'pwd',
+    'regex',
+    'sched',
+    'search',
+    'semaphore',
+    'setjmp',
+    'signal',
+    'spawn',
+    'stdarg',
+    'stdbool',
+    'stddef',
+    'stdint',
+    'stdio',
+    'stdlib',
+    'string',
+    'strings',
+    'stropts',
+    'sys/ipc',
+    'sys/mman',
+    'sys/msg',
+    'sys/resource',
+    'sys/select',
+    'sys/sem',
+    'sys/shm',
+    'sys/socket',
+    'sys/stat',
+    'sys/statvfs',
+    'sys/time',
+    'sys/times',
+    'sys/types',
+    'sys/uio',
+    'sys/un',
+    'sys/utsname',
+    'sys/wait',
+    'syslog',
+    'tar',
+    'termios',
+    'tgmath',
+    'time',
+    'trace',
+    'ulimit',
+    'unistd',
+    'utime',
+    'utmpx',
+    'wchar',
+    'wctype',
+    'wordexp',
+
+    'alloca',
+    'malloc',
+)
+
+
+_include_pattern = compile_re(rb'^ (/usr/[+\-./0-9@A-Z_a-z]+)$', M)
 
 _null_fd = open(devnull, O_RDWR)
+atexit_register(close, _null_fd)
+
+# these change the include paths cc1plus reports
+_include_env_vars = ('CPATH', 'CPLUS_INCLUDE_PATH', 'C_INCLUDE_PATH')
+
+_cache_dir = expanduser('~/.cache/ctypesgen_to_pxd')
+_cache_path = join(_cache_dir, 'includepaths.json')
 
 
-def main(dest_base='./converted_headers', *args,
-         root=dirname(abspath(__file__))):
+def _discover_includepaths():
+    gcc = which('gcc') or 'gcc'
+    gcc_stat = stat(gcc)
+    key = [gcc, gcc_stat.st_mtime, gcc_stat.st_size,
+           *(environ.get(name) for name in _include_env_vars)]
+
+    try:
+        with open_file(_cache_path) as f_cache:
+            cached = load(f_cache)
+        if cached['key'] == key:
+            return cached['includepaths']
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
     cc1plus = check_output(
-        ('gcc', '-print-prog-name=cc1plus'),
+        (gcc, '-print-prog-name=cc1plus'),
         stdin=_null_fd,
         stderr=_null_fd,
+        close_fds=False,  # lets subprocess use posix_spawn()
     ).decode('UTF-8', 'ignore').split('\n',1)[0]
 
-    includepaths = _include_pattern.findall(check_output(
-        (cc1plus, '-v'),
-        stdin=_null_fd,
-        stderr=STDOUT,
-    ).decode('UTF-8', 'ignore').split('\n\n',1)[0])
+    includepaths = list(dict.fromkeys(
+        abspath(includepath.decode('UTF-8', 'ignore'))
+        for includepath in _include_pattern.findall(check_output(
+            (cc1plus, '-v', '-o', devnull),
+            stdin=_null_fd,
+            stderr=STDOUT,
+            close_fds=False,
+        ).split(b'\n\n',1)[0])
+    ))
+
+    try:
+        makedirs(dirname(_cache_path), exist_ok=True)
+        tmp_path = '%s.%d' % (_cache_path, getpid())
+        with open_file(tmp_path, 'w') as f_cache:
+            dump({'key': key, 'includepaths': includepaths}, f_cache)
+        replace(tmp_path, _cache_path)
+    except OSError:
+        pass  # the cache is only an optimization
+
+    return includepaths
+
+
+def _find_sources(includepaths):
+    subdirs = sorted({dirname(header) for header in _HEADERS})
+    available = {}
+    for includepath in includepaths:
+        for subdir in subdirs:
+            try:
+                entries = scandir(join(includepath, subdir))
+            except OSError:
+                continue
+            with entries:
+                for entry in entries:
+                    if entry.name.endswith('.h') and entry.is_file():
+                        available.setdefault(join(subdir, entry.name[:-2]),
+                                             entry.path)
+
+    return {
+        header: available[header]
+        for header in _HEADERS
+        if header in available
+    }
+
+
+def _cache_key(header, src_path, tool_argv, tool_digest):
+    key = blake2b(tool_digest)
+    key.update(repr((header, tool_argv)).encode('UTF-8'))
+    with open_file(src_path, 'rb') as f_src:
+        key.update(f_src.read())
+    return key.hexdigest()
+
+
+def _existing_outputs(dest_base):
+    existing = set()
+    for dirpath, _, filenames in walk(dest_base):
+        for filename in filenames:
+            existing.add(relpath(join(dirpath, filename), dest_base))
+    return existing
+
+
+def _convert_one(header, src_path, dest_base, tool_argv, tool_digest):
+    dest_path = '%s/%s.pxd' % (dest_base, header)
+
+    key = _cache_key(header, src_path, tool_argv, tool_digest)
+    cached_path = join(_cache_dir, 'pxd', key[:2], key[2:] + '.pxd')
+    if lexists(cached_path):
+        # copies, not links: editing an output must not alter the cache
+        copyfile(cached_path, dest_path)
+        return '\nFrom cache: ' + src_path
 
+    try:
+        ctypesgen_to_pxd.main(
+            (*tool_argv, '-f="<%s.h>"' % header, src_path, dest_path),
+        )
+    except SystemExit as ex:
+        return '\nCould not convert: %s (exit status %r)' % (src_path, ex.code)
+
+    try:
+        makedirs(dirname(cached_path), exist_ok=True)
+        tmp_path = '%s.%d' % (cached_path, getpid())
+        copyfile(dest_path, tmp_path)
+        replace(tmp_path, cached_path)
+    except OSError:
+        pass  # the cache is only an optimization
+
+    return '\nConverted: ' + src_path
+
+
+def main(dest_base='./converted_headers', *args, jobs=None):
+    dest_base = abspath(dest_base)
+
+    with ThreadPoolExecutor(max_workers=1) as discovery:
+        includepaths_future = discovery.submit(_discover_includepaths)
+
+        with open_file(ctypesgen_to_pxd.__file__, 'rb') as f_tool:
+            tool_key = blake2b(f_tool.read())
+
+        # headers pulled in by #include and the ctypesgen version are not
+        # hashed, so key on where they come from instead
+        ctypesgen = which('ctypesgen.py')
+        if ctypesgen:
+            ctypesgen_stat = stat(ctypesgen)
+            tool_key.update(repr((ctypesgen, ctypesgen_stat.st_mtime,
+                                  ctypesgen_stat.st_size)).encode('UTF-8'))
+
+        existing = _existing_outputs(dest_base)
+
+        includepaths = includepaths_future.result()
+
+    tool_key.update(repr(includepaths).encode('UTF-8'))
+    tool_digest = tool_key.digest()
+
+    sources = _find_sources(includepaths)
+
+    report = StringIO()
     for header in _HEADERS:
-        src_paths = [
-            abspath('%s/%s.h' % (includepath, header))
-            for includepath in includepaths
-        ]
-        for src_path in src_paths:
-            if exists(src_path) and isfile(src_path):
-                break
-        else:
+        if header not in sources:
             print('\nHeader does not exists: ' + header + '. Searched in:',
-                  *src_paths, file=stderr, sep='\n')
-            continue
+                  *('%s/%s.h' % (includepath, header)
+                    for includepath in includepaths),
+                  file=report, sep='\n')
+        elif header + '.pxd' in existing:
+            print('\nAlready converted: %s/%s.pxd' % (dest_base, header),
+                  file=report)
+            del sources[header]
+    stderr.write(report.getvalue())
 
-        dest_path = abspath('%s/%s.pxd' % (dest_base, header))
-        if exists(dest_path):
-            print('\nAlready converted:', dest_path, file=stderr)
+    skipped_dirs = set()
+    for dest_dir in {dirname('%s/%s' % (dest_base, header))
+                     for header in sources}:
+        try:
+            makedirs(dest_dir, exist_ok=True)
+        except (FileExistsError, NotADirectoryError):
+            print('\nNot a directory:', dest_dir, file=stderr)
+            skipped_dirs.add(dest_dir)
             continue
+        with open_file(join(dest_dir, '__init__.pxd'), 'a'):
+            pass
 
-        dest_dir = dirname(dest_path)
-        if not exists(dest_dir):
-            makedirs(dest_dir)
-            check_call(('touch', dest_dir + '/__init__.pxd'))
-        elif not isdir(dest_dir):
-            continue
+    for header in [header for header in sources
+                   if dirname('%s/%s' % (dest_base, header)) in skipped_dirs]:
+        del sources[header]
 
-        print('\nConverting:', src_path, file=stderr)
-        check_call(
-            (root + '/ctypesgen_to_pxd.py',
-             *args, '-t=h', '-f="<%s.h>"' % header,
-             src_path, dest_path),
-        )
+    convert_one = partial(_convert_one,
+                          dest_base=dest_base,
+                          tool_argv=('ctypesgen_to_pxd.py', *args, '-t=h'),
+                          tool_digest=tool_digest)
+    with ExitStack() as stack:
+        if jobs == 1:
+            map_headers = map
+        else:
+            executor = ProcessPoolExecutor(max_workers=jobs or None)
+            map_headers = stack.enter_context(executor).map
+
+        for status in map_headers(convert_one,
+                                  sources.keys(), sources.values()):
+            if status:
+                stderr.write(status + '\n')
+
+
+def gen_argv_parser(prog):
+    parser = ArgumentParser(prog=prog,
+                            add_help=False,
+                            allow_abbrev=False,
+                            description='Convert the POSIX headers to .pxd '
+                                        'files. Unknown arguments are '
+                                        'forwarded to ctypesgen_to_pxd.')
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        default=None,
+                        dest='jobs',
+                        help='Number of headers to convert concurrently, '
+                             'default=number of CPUs. Values above the '
+                             'number of CPUs can still help when reading '
+                             'headers from a cold cache. "0" uses one per '
+                             'CPU, like the default. "1" converts the '
+                             'headers sequentially in this process.')
+    return parser
 
 
 if __name__ == '__main__':
-    main(*argv[1:])
+    parser = gen_argv_parser(argv[0])
+    known_args, rest = parser.parse_known_args(argv[1:])
+    if known_args.jobs is not None and known_args.jobs < 0:
+        parser.error('argument -j/--jobs: must not be negative')
+    main(*rest, jobs=known_args.jobs)
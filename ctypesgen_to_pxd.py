@@ -16,15 +16,25 @@
 # limitations under the License.
 
 
-from argparse import ArgumentParser
 from builtins import compile as compile_expr
-from inspect import stack, getframeinfo
-from json import loads
-from logging import getLogger, basicConfig, WARN, ERROR
-from os.path import basename, splitext
-from subprocess import Popen, PIPE, TimeoutExpired
-from sys import stdin, stdout, stderr, argv
-from textwrap import wrap
+from functools import partial
+from io import StringIO
+from json import loads, JSONDecodeError
+from logging import getLogger, basicConfig, StreamHandler, WARN, ERROR
+from os import open as os_open, close, fstat, read, O_RDONLY
+from os import cpu_count, getpid, makedirs, replace
+from os.path import basename, dirname, join, splitext
+from sys import stdin, stdout, stderr, argv, intern, _getframe
+
+try:
+    from ijson import items as iter_json_items
+except ImportError:
+    iter_json_items = None
+
+try:
+    from orjson import loads as fast_loads
+except ImportError:
+    fast_loads = None
 
 
 __author__ = 'René Kijewski  <rene.SURNAME@fu-berlin.de>'
@@ -37,11 +47,10 @@ __email__ = 'rene.SURNAME@fu-berlin.de'
 __status__ = 'Prototype'
 
 
-__all__ = ('convert',)
+__all__ = ('convert', 'render')
 
 _logger = getLogger('ctypesgen_to_pxd')
 
-NoneType = type(None)
 
 automatic_import_from = object()
 
@@ -56,12 +65,12 @@ def _stdint_gen():
                 yield ''.join((prefix, 'int', infix, '_t'))
 
 
-_STDDEF_TYPES = sorted('ptrdiff_t size_t wchar_t'.split())
-_STDINT_TYPES = sorted(_stdint_gen())
+_STDDEF_TYPES = tuple(sorted(map(intern, 'ptrdiff_t size_t wchar_t'.split())))
+_STDINT_TYPES = tuple(sorted(map(intern, _stdint_gen())))
 
-_SIMPLE_TYPES = frozenset('''
+_SIMPLE_TYPES = frozenset(map(intern, '''
     int char short void size_t ssize_t float double _Bool
-'''.split()) | set(_STDDEF_TYPES + _STDINT_TYPES)
+'''.split())).union(_STDDEF_TYPES, _STDINT_TYPES)
 
 _BinaryExpressionNode_Ops = {
     'addition': '+',
@@ -78,173 +87,219 @@ _UnaryExpressionNode_Ops = {
     'negation': '-',
 }
 
-_last_anon_enum = None, None  # FIXME: eliminate global variable
+_BINOP_GET = _BinaryExpressionNode_Ops.get
+_UNARYOP_GET = _UnaryExpressionNode_Ops.get
 
+_INDENTS = tuple('    ' * i for i in range(64))
 
-def _format_CtypesSimple(f_out, indent_level, ctype):
+# indent_level -> output of _put_std_types()
+_std_types_cache = {}
+
+
+class _Ctx:
+    __slots__ = ('out', 'write', 'anon_enum_name', 'anon_enum_fields',
+                 'base_cache', 'emitted', 'emitted_at')
+
+    def __init__(self, out, cache_bases=True):
+        self.out = out
+        self.write = out.write  # lets _put() and _warn() take a _Ctx
+        self.anon_enum_name = self.anon_enum_fields = None
+        # id(base) -> (base, fragments), or None to keep no base alive
+        self.base_cache = {} if cache_bases else None
+        # lines written by _put_once(), and where, if a worker needs it
+        self.emitted = set()
+        self.emitted_at = None
+
+
+def _simple_format(name, signed, longs):
+    signedness = ('unsigned ' if not signed else
+                  'signed ' if name in ('int', 'short') else
+                  '')
+    return (signedness, 'long ' * longs, name)
+
+
+_SIMPLE_FORMATS = {
+    (name, signed, longs): _simple_format(name, signed, longs)
+    for name in _SIMPLE_TYPES
+    for signed in (False, True)
+    for longs in range(3)
+}
+
+
+def _format_CtypesSimple(ctx, indent_level, ctype):
     name = ctype.get('name')
+    signed = bool(ctype.get('signed'))
+    longs = ctype.get('longs') or 0
+    args = _SIMPLE_FORMATS.get((name, signed, longs))
+    if args:
+        return args
+
     if name in _SIMPLE_TYPES:
-        signed = ctype.get('signed')
-        longs = ctype.get('longs') or 0
-        signedness = ('unsigned ' if not signed else
-                      'signed ' if name in ('int', 'short') else
-                      '')
-        return (signedness, 'long ' * longs, name)
-
-    _warn(f_out, indent_level, 'Unknown CtypesSimple name=%r', name)
+        args = _simple_format(intern(name), signed, longs)
+        _SIMPLE_FORMATS[name, signed, longs] = args
+        return args
+
+    _warn(ctx, indent_level, 'Unknown CtypesSimple name=%r', name)
     return False
 
 
-def _convert_constant(f_out, indent_level, definition):
-    name = definition.get('name')
-    value = definition.get('value')
+def _extract(definition, keys):
+    try:
+        return tuple(map(definition.__getitem__, keys))
+    except KeyError:
+        return tuple(map(definition.get, keys))
+
+
+def _convert_constant(ctx, indent_level, definition):
+    name, value = _extract(definition, ('name', 'value'))
 
     if not name or not value:
-        _warn(f_out, indent_level,
+        _warn(ctx, indent_level,
               'Unknown constant name=%r value=%r', name, value)
         return False
 
-    _anon_enum_name, _anon_enum_fields = _last_anon_enum
-    if _anon_enum_name and name in _anon_enum_fields:
-        _put(f_out, indent_level,
-             'cdef enum:  # was anonymous enum: ', _anon_enum_name)
-        _put(f_out, indent_level + 1, name, ' = ', _anon_enum_name, '.', name)
+    anon_enum_name = ctx.anon_enum_name
+    if anon_enum_name and name in ctx.anon_enum_fields:
+        _put(ctx, indent_level,
+             'cdef enum:  # was anonymous enum: ', anon_enum_name)
+        _put(ctx, indent_level + 1, name, ' = ', anon_enum_name, '.', name)
         return True
 
-    _put(f_out, indent_level, 'cdef enum:  # was a constant: ', repr(value))
-    _put(f_out, indent_level + 1, name)
+    _put(ctx, indent_level, 'cdef enum:  # was a constant: ', repr(value))
+    _put(ctx, indent_level + 1, name)
     return True
 
 
-def _format_rhs_ConstantExpressionNode(f_out, indent_level, definition):
-    value = definition.get('value')
-    if value is not None:
-        return value,
-
-
-def _format_rhs_BinaryExpressionNode(f_out, indent_level, definition):
-    name = definition.get('name')
+def _format_rhs_BinaryExpressionNode(ctx, indent_level, definition,
+                                     out, todo):
+    get = definition.get
+    name = get('name')
     if not name:
         _logger.error('Unknown BinaryExpressionNode name=%r', name)
         return False
 
-    left = definition.get('left')
-    right = definition.get('right')
-    if not all(isinstance(i, dict) for i in (left, right)):
+    left = get('left')
+    right = get('right')
+    if type(left) is not dict or type(right) is not dict:
         _logger.error('Unknown BinaryExpressionNode type(left)=%r '
                       'type(right)=%r', type(left), type(right))
         return False
 
-    left_args = _format_rhs(f_out, indent_level, left)
-    if not left_args:
-        return left_args
-
-    right_args = _format_rhs(f_out, indent_level, right)
-    if not right_args:
-        return right_args
-
-    op = _BinaryExpressionNode_Ops.get(name)
+    op = _BINOP_GET(name)
     if op:
-        return ('((', *left_args, ') ', op, ' (', *right_args, '))')
+        closer = '))'
+    else:
+        closer = 'Unsupported BinaryExpressionNode name=%r', name
 
-    _warn(f_out, indent_level,
-          'Unsupported BinaryExpressionNode name=%r', name)
-    return False
+    out.append('((')
+    todo.extend((closer, right, ') %s (' % (op or ''), left))
+    return True
 
 
-def _format_rhs_UnaryExpressionNode(f_out, indent_level, definition):
-    name = definition.get('name')
-    child = definition.get('child')
-    if not name or not isinstance(child, dict):
+def _format_rhs_UnaryExpressionNode(ctx, indent_level, definition,
+                                    out, todo):
+    get = definition.get
+    name = get('name')
+    child = get('child')
+    if not name or type(child) is not dict:
         _logger.error('Unknown UnaryExpressionNode name=%r type(child)=%r',
                       name, type(child))
         return False
 
-    child_args = _format_rhs(f_out, indent_level, child)
-    if not child_args:
-        return child_args
-
-    op = _UnaryExpressionNode_Ops.get(name)
+    op = _UNARYOP_GET(name)
     if op:
-        return ('(', op, ' (', *child_args, '))')
+        closer = '))'
+    else:
+        closer = 'Unsupported UnaryExpressionNode name=%r', name
 
-    _warn(f_out, indent_level,
-          'Unsupported UnaryExpressionNode name=%r', name)
-    return False
+    out.append('(%s (' % (op or ''))
+    todo.extend((closer, child))
+    return True
 
 
-def _format_rhs_IdentifierExpressionNode(f_out, indent_level, definition):
+def _format_rhs_IdentifierExpressionNode(ctx, indent_level, definition,
+                                         out, todo):
     name = definition.get('name')
     if not name:
         _logger.error('Unknown IdentifierExpressionNode name=%r', name)
         return False
 
-    return name,
+    out.append(name)
+    return True
 
 
-def _format_rhs_SizeOfExpressionNode(f_out, indent_level, definition):
+def _format_rhs_SizeOfExpressionNode(ctx, indent_level, definition,
+                                     out, todo):
     child = definition.get('child')
-    if not isinstance(child, dict):
+    if type(child) is not dict:
         _logger.error('Unknown SizeOfExpressionNode type(child)=%r',
                       type(child))
         return False
 
-    child_args = _convert_base_Klass(f_out, indent_level, child)
-    if not child_args:
-        return child_args
+    out.append('(sizeof(')
+    if not _convert_base_Klass(ctx, indent_level, child, out):
+        return False
 
-    return ('(sizeof(', *child_args, '))')
+    out.append('))')
+    return True
 
 
-def _format_rhs_ConditionalExpressionNode(f_out, indent_level, definition):
-    cond = definition.get('cond')
-    no = definition.get('no')
-    yes = definition.get('yes')
-    if any(not isinstance(i, dict) for i in (cond, no, yes)):
+def _format_rhs_ConditionalExpressionNode(ctx, indent_level, definition,
+                                          out, todo):
+    get = definition.get
+    cond = get('cond')
+    no = get('no')
+    yes = get('yes')
+    if type(cond) is not dict or type(no) is not dict or \
+       type(yes) is not dict:
         _logger.error('Unknown ConditionalExpressionNode type(cond)=%r '
                       'type(no)=%r type(yes)=%r',
                       type(cond), type(no), type(yes))
         return False
 
-    cond_args = _format_rhs(f_out, indent_level, cond)
-    if not cond_args:
-        return cond_args
+    # the branches are formatted in source order, but emitted yes-first
+    cond_args = []
+    if not _format_rhs(ctx, indent_level, cond, cond_args):
+        return False
 
-    no_args = _format_rhs(f_out, indent_level, no)
-    if not no_args:
-        return no_args
+    no_args = []
+    if not _format_rhs(ctx, indent_level, no, no_args):
+        return False
 
-    yes_args = _format_rhs(f_out, indent_level, yes)
-    if not yes_args:
-        return yes_args
+    out.append('((')
+    if not _format_rhs(ctx, indent_level, yes, out):
+        return False
 
-    return ('((', *yes_args, ') if (',
-            *cond_args, ') else (', *no_args, '))')
+    out.append(') if (')
+    out.extend(cond_args)
+    out.append(') else (')
+    out.extend(no_args)
+    out.append('))')
+    return True
 
 
-def _format_rhs_TypeCastExpressionNode(f_out, indent_level, definition):
-    ctype = definition.get('ctype')
-    base = definition.get('base')
-    if any(not isinstance(i, dict) for i in (ctype, base)):
+def _format_rhs_TypeCastExpressionNode(ctx, indent_level, definition,
+                                       out, todo):
+    get = definition.get
+    ctype = get('ctype')
+    base = get('base')
+    if type(ctype) is not dict or type(base) is not dict:
         _logger.error('Unknown TypeCastExpressionNode type(ctype)=%r '
                       'type(base)=%r', type(ctype), type(base))
         return False
 
-    type_args = _convert_base_Klass(f_out, indent_level, ctype)
-    if not type_args:
-        return type_args
-
-    base_args = _format_rhs(f_out, indent_level, base)
-    if not base_args:
-        return base_args
+    out.append('(<')
+    if not _convert_base_Klass(ctx, indent_level, ctype, out):
+        return False
 
-    return ('(<', *type_args, '> (', *base_args, '))')
+    out.append('> (')
+    todo.extend(('))', base))
+    return True
 
 
 _FORMAT_RHS_FUNS = {
     'BinaryExpressionNode': _format_rhs_BinaryExpressionNode,
     'ConditionalExpressionNode': _format_rhs_ConditionalExpressionNode,
-    'ConstantExpressionNode': _format_rhs_ConstantExpressionNode,
     'IdentifierExpressionNode': _format_rhs_IdentifierExpressionNode,
     'SizeOfExpressionNode': _format_rhs_SizeOfExpressionNode,
     'TypeCastExpressionNode': _format_rhs_TypeCastExpressionNode,
@@ -252,163 +307,180 @@ _FORMAT_RHS_FUNS = {
 }
 
 
-def _format_rhs(f_out, indent_level, definition):
-    klass = definition.get('Klass')
-    if not klass:
-        _logger.error('Unknown rhs Klass=%r', klass)
-        return False
+def _format_rhs(ctx, indent_level, definition, out):
+    # Iterative walk: the node functions emit their leading fragments into
+    # out, and push their children and trailing fragments onto todo.
+    # A tuple on todo is a deferred warning that fails the expression.
+    todo = [definition]
+    while todo:
+        item = todo.pop()
+        if type(item) is str:
+            out.append(item)
+            continue
+        elif type(item) is tuple:
+            _warn(ctx, indent_level, *item)
+            return False
 
-    convert_fun = _FORMAT_RHS_FUNS.get(klass)
-    if convert_fun:
-        return convert_fun(f_out, indent_level, definition)
+        get = item.get
+        if get('Klass') == 'ConstantExpressionNode':
+            # by far the most common node, so it is handled inline
+            value = get('value')
+            if value is None:
+                return False
 
-    _warn(f_out, indent_level, 'Unsupported rhs Klass=%r', klass)
-    return False
+            out.append(str(value))
+            continue
 
+        try:
+            convert_fun = _FORMAT_RHS_FUNS[item['Klass']]
+        except KeyError:
+            klass = item.get('Klass')
+            if not klass:
+                _logger.error('Unknown rhs Klass=%r', klass)
+                return False
 
-def _convert_enum(f_out, indent_level, definition):
-    global _last_anon_enum
+            _warn(ctx, indent_level, 'Unsupported rhs Klass=%r', klass)
+            return False
 
-    name = definition.get('name')
-    fields = definition.get('fields')
-    if not name or not isinstance(fields, (list, NoneType)):
+        if not convert_fun(ctx, indent_level, item, out, todo):
+            return False
+
+    return True
+
+
+def _convert_enum(ctx, indent_level, definition):
+    name, fields = _extract(definition, ('name', 'fields'))
+    if not name or (fields is not None and type(fields) is not list):
         _logger.error('Unknown enum name=%r type(fields)=%r',
                       name, type(fields))
         return False
 
     if name.startswith('anon_'):
-        _last_anon_enum = name, {field.get('name') for field in fields}
+        ctx.anon_enum_name = name
+        ctx.anon_enum_fields = {field.get('name') for field in fields}
 
     printed = None
     if fields:
         for field in fields:
-            field_name = field.get('name')
+            field_name, ctype = _extract(field, ('name', 'ctype'))
             if not field_name:
                 _logger.error('Unknown enum field name=%r', field_name)
                 continue
 
-            ctype = field.get('ctype')
-            if not isinstance(ctype, dict):
+            if type(ctype) is not dict:
                 _logger.error('Unknown enum field ctype=%r', ctype)
                 continue
 
-            value_args = _format_rhs(f_out, indent_level, ctype)
-            if not value_args:
+            value_args = []
+            if not _format_rhs(ctx, indent_level, ctype, value_args):
                 continue
 
             if not printed:
-                _put(f_out, indent_level, 'cdef enum ', name or '', ':')
+                _put(ctx, indent_level, 'cdef enum ', name or '', ':')
                 printed = True
 
-            _put(f_out, indent_level + 1, field_name, ' = (', *value_args, ')')
+            _put(ctx, indent_level + 1, field_name, ' = (', *value_args, ')')
 
     return printed
 
 
-def _format_function(f_out, indent_level, definition):
+def _format_function(ctx, indent_level, definition):
     _absent = object()
+    get = definition.get
 
-    variadic = definition.get('variadic')
+    variadic = get('variadic')
 
-    returns = definition.get('return', _absent)
+    returns = get('return', _absent)
     if returns is _absent:
-        returns = definition.get('restype')
+        returns = get('restype')
 
-    args = definition.get('args', _absent)
+    args = get('args', _absent)
     if args is _absent:
-        args = definition.get('argtypes')
+        args = get('argtypes')
 
-    if not isinstance(returns, (dict, NoneType)):
+    if returns is not None and type(returns) is not dict:
         _logger.error('Unknown fuction type(return)=%r', type(returns))
         return False
-    elif not isinstance(args, (list, NoneType)):
+    elif args is not None and type(args) is not list:
         _logger.error('Unknown fuction type(args)=%r', type(returns))
         return False
 
     if returns:
-        returns_args = _convert_base_Klass(f_out, indent_level, returns)
-        if not returns_args:
-            return returns_args
+        returns_args = []
+        if not _convert_base_Klass(ctx, indent_level, returns, returns_args):
+            return False
     else:
-        returns_args = 'void',
+        returns_args = ['void']
 
-    args_args = ()
+    args_args = []
     if args:
         for i in args:
-            i_args = _convert_base_Klass(f_out, indent_level, i)
-            if not i_args:
-                return i_args
-            elif args_args:
-                args_args = (*args_args, ', ', *i_args)
-            else:
-                args_args = i_args
+            if args_args:
+                args_args.append(', ')
+            if not _convert_base_Klass(ctx, indent_level, i, args_args):
+                return False
 
     if variadic:
-        if args_args:
-            args_args = (*args_args, ', ...')
-        else:
-            args_args = ('...',)
+        args_args.append(', ...' if args_args else '...')
 
     return returns_args, args_args
 
 
-def _convert_function(f_out, indent_level, definition):
+def _convert_function(ctx, indent_level, definition):
     name = definition.get('name')
     if not name:
         _logger.error('Unknown fuction name=%r', name)
         return False
 
-    args = _format_function(f_out, indent_level, definition)
+    args = _format_function(ctx, indent_level, definition)
     if not args:
         return args
 
     returns_args, args_args = args
 
-    if returns_args == (name,):
-        _warn(f_out, indent_level, 'Function has the same name as its '
-                                   'return type: %r', name)
-        _put(f_out, indent_level,
+    if returns_args == [name]:
+        _warn(ctx, indent_level, 'Function has the same name as its '
+                                 'return type: %r', name)
+        _put(ctx, indent_level,
              'cdef extern ', *returns_args, ' ', name, '_function ',
              repr(name), ' (', *args_args, ') ')
     else:
-        _put(f_out, indent_level,
+        _put(ctx, indent_level,
              'cdef ', *returns_args, ' ', name, '(', *args_args, ')')
     return True
 
 
-def _convert_macro(f_out, indent_level, definition):
-    name = definition.get('name')
-    value = definition.get('value')
+def _convert_macro(ctx, indent_level, definition):
+    name, value = _extract(definition, ('name', 'value'))
 
     if name == value:
         _logger.info('Macro omitted: %s', name)
         return False  # sic
 
-    _put(f_out, indent_level, 'cdef enum:  # was a macro: %r' % value)
-    _put(f_out, indent_level + 1, name)
+    _put(ctx, indent_level, 'cdef enum:  # was a macro: %r' % value)
+    _put(ctx, indent_level + 1, name)
     return True
 
 
-def _convert_variable(f_out, indent_level, definition):
-    name = definition.get('name')
+def _convert_variable(ctx, indent_level, definition):
+    name, ctype = _extract(definition, ('name', 'ctype'))
     if not name:
         _logger.error('Unknown variable name=%r', name)
         return False
 
-    ctype = definition.get('ctype')
-    if not isinstance(ctype, dict):
+    if type(ctype) is not dict:
         _logger.error('Unknown variable type(ctype)=%r', type(ctype))
         return False
 
     klass = ctype.get('Klass')
-    if not isinstance(klass, str):
+    if type(klass) is not str:
         _logger.error('Unknown variable ctype.Klass=%r', klass)
         return False
 
     pointers = 0
     while klass == 'CtypesPointer':
         destination = ctype.get('destination')
-        if not isinstance(destination, dict):
+        if type(destination) is not dict:
             _logger.error('Unknown CtypesPointer type(destination)=%r',
                           type(destination))
             return False
@@ -418,17 +490,17 @@ def _convert_variable(f_out, indent_level, definition):
         pointers += 1
 
     if klass == 'CtypesArray':
-        args = _format_CtypesArray(f_out, indent_level, ctype)
+        args = _format_CtypesArray(ctx, indent_level, ctype)
         if not args:
             return args
 
         base_args, count_args = args
-        _put(f_out, indent_level, 'cdef extern ', *base_args, ' ', name,
+        _put(ctx, indent_level, 'cdef extern ', *base_args, ' ', name,
              '[', *count_args, ']')
         return True
 
     elif klass == 'CtypesFunction':
-        args = _format_function(f_out, indent_level, ctype)
+        args = _format_function(ctx, indent_level, ctype)
         if not args:
             return args
 
@@ -438,24 +510,23 @@ def _convert_variable(f_out, indent_level, definition):
             name = name,
 
         returns_args, args_args = args
-        _put(f_out, indent_level, 'cdef extern ', *returns_args, ' ', *name,
+        _put(ctx, indent_level, 'cdef extern ', *returns_args, ' ', *name,
              '(', *args_args, ')')
         return True
 
     else:
-        type_args = _convert_base_Klass(f_out, indent_level, ctype)
-        if not type_args:
-            return type_args
+        type_args = []
+        if not _convert_base_Klass(ctx, indent_level, ctype, type_args):
+            return False
 
-        _put(f_out, indent_level, 'cdef extern ', *type_args, ' ',
+        _put(ctx, indent_level, 'cdef extern ', *type_args, ' ',
              '*' * pointers, name)
         return True
 
 
-def _convert_struct(f_out, indent_level, definition, struct='struct'):
-    name = definition.get('name')
-    fields = definition.get('fields')
-    if not name or not isinstance(fields, (list, NoneType)):
+def _convert_struct(ctx, indent_level, definition, struct='struct'):
+    name, fields = _extract(definition, ('name', 'fields'))
+    if not name or (fields is not None and type(fields) is not list):
         _logger.error('Unknown %s data name=%r type(ctype)=%r',
                       struct, name, type(fields))
         return False
@@ -463,16 +534,16 @@ def _convert_struct(f_out, indent_level, definition, struct='struct'):
     name_args = name,
 
     if fields is None:
-        _put(f_out, indent_level,
-             'cdef ', struct, ' ', *name_args, '  # forward declaration')
-        return True
+        return _put_once(ctx, indent_level, ''.join((
+            'cdef ', struct, ' ', *name_args, '  # forward declaration',
+        )))
 
     fields_args = []
     for field_i, field in enumerate(fields):
-        name = field.get('name') or ('__member_%d' % field_i)
+        name, ctype = _extract(field, ('name', 'ctype'))
+        name = name or ('__member_%d' % field_i)
 
-        ctype = field.get('ctype')
-        if not isinstance(ctype, dict):
+        if type(ctype) is not dict:
             _logger.error('Unknown typedef data type(ctype)=%r', type(ctype))
             return False
 
@@ -480,7 +551,7 @@ def _convert_struct(f_out, indent_level, definition, struct='struct'):
         if klass != 'CtypesArray':
             if klass == 'CtypesPointer':
                 destination = ctype.get('destination')
-                if not isinstance(destination, dict):
+                if type(destination) is not dict:
                     _logger.error('Unknown CtypesPointer type(destination)=%r',
                                   type(destination))
                     return False
@@ -489,51 +560,52 @@ def _convert_struct(f_out, indent_level, definition, struct='struct'):
                 subname = destination.get('name')
                 if (subklass == 'CtypesTypedef') and \
                    (subname in INCOMPLETE_STRUCT_TYPES):
-                    _warn(f_out, indent_level, 'Replacing "%s %s" by void',
+                    _warn(ctx, indent_level, 'Replacing "%s %s" by void',
                           subname, name)
-                    destination.update({
+                    # copy, the destination node may be shared
+                    ctype = dict(ctype, destination={
                         'Klass': 'CtypesSimple',
                         'longs': 0,
                         'name': 'void',
                         'signed': True
                     })
 
-            convert_fun = _CONVERT_TYPEDEF_FUNS.get(klass)
+            convert_fun = _CONVERT_TYPEDEF_FUNS_GET(klass)
             if not convert_fun:
-                _warn(f_out, indent_level, 'Unknown typedef Klass=%r', klass)
+                _warn(ctx, indent_level, 'Unknown typedef Klass=%r', klass)
                 return False
 
-            field_args = convert_fun(f_out, indent_level, name, ctype,
+            field_args = convert_fun(ctx, indent_level, name, ctype,
                                      include_cdef=False)
             if not field_args:
                 return field_args
 
         else:  # klass == 'CtypesArray'
-            array_args = _format_CtypesArray(f_out, indent_level, ctype)
+            array_args = _format_CtypesArray(ctx, indent_level, ctype)
             if not array_args:
                 return array_args
             base_args, count_args = array_args
 
-            _put(f_out, indent_level,
+            _put(ctx, indent_level,
                  '# ', *base_args, ' ', name, '[', *count_args, ']')
             field_args = (*base_args, ' ', name, '[1]')
 
         fields_args.append(field_args)
 
-    _put(f_out, indent_level, 'cdef ', struct, ' ', *name_args, ':')
+    _put(ctx, indent_level, 'cdef ', struct, ' ', *name_args, ':')
     for field_args in fields_args:
-        _put(f_out, indent_level + 1, *field_args)
+        _put(ctx, indent_level + 1, *field_args)
 
     return True
 
 
-def _convert_union(f_out, indent_level, definition):
-    return _convert_struct(f_out, indent_level, definition, struct='union')
+def _convert_union(ctx, indent_level, definition):
+    return _convert_struct(ctx, indent_level, definition, struct='union')
 
 
-def _convert_typedef_CtypesSimple(f_out, indent_level,
+def _convert_typedef_CtypesSimple(ctx, indent_level,
                                   name, ctype, include_cdef):
-    args = _format_CtypesSimple(f_out, indent_level, ctype)
+    args = _format_CtypesSimple(ctx, indent_level, ctype)
     if not args:
         return args
 
@@ -543,7 +615,7 @@ def _convert_typedef_CtypesSimple(f_out, indent_level,
     )
 
 
-def _convert_typedef_CtypesEnum(f_out, indent_level,
+def _convert_typedef_CtypesEnum(ctx, indent_level,
                                 name, ctype, include_cdef):
     tag = ctype.get('tag')
     if not tag:
@@ -553,10 +625,10 @@ def _convert_typedef_CtypesEnum(f_out, indent_level,
     return ('ctypedef ' if include_cdef else '', tag, ' ', name or '')
 
 
-def _convert_typedef_CtypesBitfield(f_out, indent_level,
+def _convert_typedef_CtypesBitfield(ctx, indent_level,
                                     name, ctype, include_cdef):
     base = ctype.get('base')
-    if not isinstance(base, dict):
+    if type(base) is not dict:
         _logger.error('Unknown CtypesBitfield type(base)=%r', type(base))
         return False
 
@@ -565,16 +637,16 @@ def _convert_typedef_CtypesBitfield(f_out, indent_level,
         _logger.error('Unknown CtypesBitfield Klass=%r', klass)
         return False
 
-    convert_fun = _CONVERT_TYPEDEF_FUNS.get(klass)
+    convert_fun = _CONVERT_TYPEDEF_FUNS_GET(klass)
     if convert_fun:
-        _warn(f_out, indent_level, 'Bitfield specification ignored in .pxd')
-        return convert_fun(f_out, indent_level, name, base, include_cdef)
+        _warn(ctx, indent_level, 'Bitfield specification ignored in .pxd')
+        return convert_fun(ctx, indent_level, name, base, include_cdef)
 
-    _warn(f_out, indent_level, 'Unsupported CtypesBitfield Klass=%r', klass)
+    _warn(ctx, indent_level, 'Unsupported CtypesBitfield Klass=%r', klass)
     return False
 
 
-def _convert_typedef_CtypesStruct(f_out, indent_level,
+def _convert_typedef_CtypesStruct(ctx, indent_level,
                                   name, ctype, include_cdef):
     variety = ctype.get('variety')
     if variety not in ('struct', 'union'):
@@ -592,117 +664,152 @@ def _convert_typedef_CtypesStruct(f_out, indent_level,
     return ('ctypedef ' if include_cdef else '', tag, ' ', name or '')
 
 
-def _convert_base_CtypesSimple(f_out, indent_level, base):
-    return _format_CtypesSimple(f_out, indent_level, base)
+def _convert_base_CtypesSimple(ctx, indent_level, base, out):
+    args = _format_CtypesSimple(ctx, indent_level, base)
+    if not args:
+        return False
+
+    out.extend(args)
+    return True
 
 
-def _convert_base_CtypesStruct(f_out, indent_level, base):
+def _convert_base_CtypesStruct(ctx, indent_level, base, out):
     tag = base.get('tag')
     variety = base.get('variety')
     if not tag or not variety:
         _logger.error('Unsupported base Klass=%r tag=%r variety=%r',
-                      klass, tag, variety)
+                      base.get('Klass'), tag, variety)
         return False
 
     if tag in INCOMPLETE_STRUCT_TYPES:
-        _warn(f_out, indent_level, 'Replacing %r by void*', tag)
-        return 'void*',
+        _warn(ctx, indent_level, 'Replacing %r by void*', tag)
+        out.append('void*')
+        return True
 
-    return tag,
+    out.append(tag)
+    return True
 
 
-def _convert_base_CtypesPointer(f_out, indent_level, base):
-    destination = base.get('destination')
-    if not isinstance(destination, dict):
-        _logger.error('Unsupported base Klass type(destination)=%r',
-                      destination)
-        return False
+def _convert_base_CtypesPointer(ctx, indent_level, base, out):
+    pointers = 0
+    while base.get('Klass') == 'CtypesPointer':
+        destination = base.get('destination')
+        if type(destination) is not dict:
+            _logger.error('Unsupported base Klass type(destination)=%r',
+                          destination)
+            return False
 
-    args = _convert_base_Klass(f_out, indent_level, destination)
-    if not args:
-        return args
+        base = destination
+        pointers += 1
 
-    return (*args, '*')
+    if not _convert_base_Klass(ctx, indent_level, base, out):
+        return False
+
+    out.append('*' * pointers)
+    return True
 
 
-def _convert_base_CtypesTypedef(f_out, indent_level, base):
+def _convert_base_CtypesTypedef(ctx, indent_level, base, out):
     name = base.get('name')
     if not name:
         _logger.error('Unsupported base Klass CtypesTypedef name=%r', name)
         return False
 
-    return (name or identifier,)
+    out.append(name)
+    return True
 
 
-def _convert_base_CtypesFunction(f_out, indent_level, base):
-    args = _format_function(f_out, indent_level, base)
+def _convert_base_CtypesFunction(ctx, indent_level, base, out):
+    args = _format_function(ctx, indent_level, base)
     if not args:
-        return args
+        return False
 
     returns_args, args_args = args
-
-    return (*returns_args, '(', *args_args, ')')
+    out.extend(returns_args)
+    out.append('(')
+    out.extend(args_args)
+    out.append(')')
+    return True
 
 
-def _convert_base_CtypesArray(f_out, indent_level, base):
-    args = _format_CtypesArray(f_out, indent_level, base)
+def _convert_base_CtypesArray(ctx, indent_level, base, out):
+    args = _format_CtypesArray(ctx, indent_level, base)
     if not args:
-        return args
+        return False
 
     base_args, count_args = args
-    return (*base_args, '[', *count_args, ']')
+    out.extend(base_args)
+    out.append('[')
+    out.extend(count_args)
+    out.append(']')
+    return True
 
 
-def _convert_base_CtypesSpecial(f_out, indent_level, base):
+def _convert_base_CtypesSpecial(ctx, indent_level, base, out):
     name = base.get('name')
     if not name:
         _logger.error('Unsupported base Klass CtypesSpecial name=%r', name)
 
     if name == 'String':
-        return 'char*',
+        out.append('char*')
+        return True
 
-    _warn(f_out, indent_level, 'Unknown CtypesSpecial name=%r', name)
+    _warn(ctx, indent_level, 'Unknown CtypesSpecial name=%r', name)
     return False
 
 
-def _convert_base_Klass(f_out, indent_level, base):
-    klass = base.get('Klass')
-    convert_fun = _CONVERT_BASE_FUNS.get(klass)
-    if convert_fun:
-        return convert_fun(f_out, indent_level, base)
-    else:
-        _warn(f_out, indent_level, 'Unsupported base Klass=%r', klass)
+def _convert_base_Klass(ctx, indent_level, base, out):
+    base_cache = ctx.base_cache
+    if base_cache is not None:
+        cached = base_cache.get(id(base))
+        if cached is not None and cached[0] is base:
+            out.extend(cached[1])
+            return True
+
+    try:
+        convert_fun = _CONVERT_BASE_FUNS[base['Klass']]
+    except KeyError:
+        _warn(ctx, indent_level,
+              'Unsupported base Klass=%r', base.get('Klass'))
+        return False
+
+    start = len(out)
+    position = ctx.out.tell()
+    if not convert_fun(ctx, indent_level, base, out):
         return False
 
+    # results that came with a warning must warn again on the next use
+    if base_cache is not None and ctx.out.tell() == position:
+        base_cache[id(base)] = base, out[start:]
+    return True
+
 
-def _format_CtypesArray(f_out, indent_level, ctype):
+def _format_CtypesArray(ctx, indent_level, ctype):
     base = ctype.get('base')
-    if not isinstance(base, dict):
+    if type(base) is not dict:
         _logger.error('CtypesArray type(base)=%r', type(base))
         return False
 
     count = ctype.get('count')
-    if not isinstance(count, (dict, NoneType)):
+    if count is not None and type(count) is not dict:
         _logger.error('CtypesArray type(count)=%r', type(count))
         return False
 
+    count_args = []
     if count is not None:
-        count_args = _format_rhs(f_out, indent_level, count)
-        if not count_args:
-            return count_args
-    else:
-        count_args = ()
+        if not _format_rhs(ctx, indent_level, count, count_args):
+            return False
 
-    base_args = _convert_base_Klass(f_out, indent_level, base)
-    if not base_args:
-        return base_args
+    base_args = []
+    if not _convert_base_Klass(ctx, indent_level, base, base_args):
+        return False
 
     return base_args, count_args
 
 
-def _convert_typedef_CtypesArray(f_out, indent_level,
+def _convert_typedef_CtypesArray(ctx, indent_level,
                                  name, ctype, include_cdef):
-    args = _format_CtypesArray(f_out, indent_level, ctype)
+    args = _format_CtypesArray(ctx, indent_level, ctype)
     if not args:
         return args
 
@@ -713,7 +820,7 @@ def _convert_typedef_CtypesArray(f_out, indent_level,
     )
 
 
-def _convert_typedef_CtypesSpecial(f_out, indent_level,
+def _convert_typedef_CtypesSpecial(ctx, indent_level,
                                    name, ctype, include_cdef):
     special_name = ctype.get('name')
     if not special_name:
@@ -726,22 +833,22 @@ def _convert_typedef_CtypesSpecial(f_out, indent_level,
             'char* ', name or '',
         )
 
-    _warn(f_out, indent_level,
+    _warn(ctx, indent_level,
           'Unsupported CtypesSpecial name=%r', special_name)
     return False
 
 
-def _convert_typedef_CtypesPointer(f_out, indent_level,
+def _convert_typedef_CtypesPointer(ctx, indent_level,
                                    name, ctype, include_cdef):
     destination = ctype.get('destination')
-    if not isinstance(destination, dict):
+    if type(destination) is not dict:
         _logger.error('Unsupported base Klass type(destination)=%r',
                       destination)
         return False
 
-    args = _convert_base_Klass(f_out, indent_level, destination)
-    if not args:
-        return args
+    args = []
+    if not _convert_base_Klass(ctx, indent_level, destination, args):
+        return False
 
     return (
         'ctypedef ' if include_cdef else '',
@@ -749,9 +856,9 @@ def _convert_typedef_CtypesPointer(f_out, indent_level,
     )
 
 
-def _convert_typedef_CtypesFunction(f_out, indent_level,
+def _convert_typedef_CtypesFunction(ctx, indent_level,
                                     name, ctype, include_cdef):
-    args = _format_function(f_out, indent_level, ctype)
+    args = _format_function(ctx, indent_level, ctype)
     if not args:
         return args
 
@@ -762,96 +869,149 @@ def _convert_typedef_CtypesFunction(f_out, indent_level,
     )
 
 
-def _convert_typedef_CtypesTypedef(f_out, indent_level,
+def _convert_typedef_CtypesTypedef(ctx, indent_level,
                                    name, ctype, include_cdef):
     base_name = ctype.get('name')
     if not base_name:
         _logger.error('Unknown CtypesTypedef name=%r', base_name)
         return False
 
+    if include_cdef and base_name == name:
+        return False  # sic, but a struct field may share its type's name
+
     return (
         'ctypedef ' if include_cdef else '',
         base_name, ' ', name or '',
     )
 
 
-def _convert_typedef(f_out, indent_level, definition, include_cdef=True):
-    name = definition.get('name')
+def _convert_typedef(ctx, indent_level, definition, include_cdef=True):
+    name, ctype = _extract(definition, ('name', 'ctype'))
     if not name and include_cdef:
         _logger.error('Unknown typedef data name=%r', name)
         return False
 
-    ctype = definition.get('ctype')
-    if not isinstance(ctype, dict):
+    if type(ctype) is not dict:
         _logger.error('Unknown typedef data type(ctype)=%r', type(ctype))
         return False
 
-    klass = ctype.get('Klass')
-    convert_fun = _CONVERT_TYPEDEF_FUNS.get(klass)
-    if convert_fun:
-        args = convert_fun(f_out, indent_level, name, ctype, include_cdef)
-        if not args:
-            return args
+    try:
+        convert_fun = _CONVERT_TYPEDEF_FUNS[ctype['Klass']]
+    except KeyError:
+        _warn(ctx, indent_level,
+              'Unknown typedef Klass=%r', ctype.get('Klass'))
+        return False
 
-        _put(f_out, indent_level, *args)
-        return True
+    args = convert_fun(ctx, indent_level, name, ctype, include_cdef)
+    if not args:
+        return args
 
-    else:
-        _warn(f_out, indent_level, 'Unknown typedef Klass=%r', klass)
+    return _put_once(ctx, indent_level, ''.join(args))
 
 
-def _convert_macro_function(f_out, indent_level, definition,
+def _convert_macro_function(ctx, indent_level, definition,
                             include_cdef=True):
-    name = definition.get('name')
-    args = definition.get('args') or ()
-    body = definition.get('body') or ''
+    name, args, body = _extract(definition, ('name', 'args', 'body'))
+    args = args or ()
+    body = body or ''
     if not name:
         _logger.error('Unknown macro function name=%r', name)
         return False
 
-    _warn(f_out, indent_level,
+    _warn(ctx, indent_level,
           'Return type and arguments unknown for macro function: %s(%s) %r',
           name, ', '.join(args), body)
-    _put(f_out, indent_level, 'cdef void* ', name, '(...)')
+    _put(ctx, indent_level, 'cdef void* ', name, '(...)')
     return True
 
 
-def _put(f_out, indent_level, *args, **kw):
-    print('    ' * indent_level, *args, file=f_out, sep='')
+def _put(f_out, indent_level, *args):
+    indent = (_INDENTS[indent_level] if indent_level < len(_INDENTS) else
+              '    ' * indent_level)
+    f_out.write(''.join((indent, *args, '\n')))
+
+
+def _put_once(ctx, indent_level, line):
+    if line in ctx.emitted:
+        return False  # e.g. a typedef repeated by ctypesgen
+
+    ctx.emitted.add(line)
+    if ctx.emitted_at is not None:
+        ctx.emitted_at.append((ctx.out.tell(), line))
+    _put(ctx, indent_level, line)
+    return True
 
 
 def _warn(f_out, indent_level, warn_format, *args):
-    caller = getframeinfo(stack()[1][0])
     msg = warn_format % args
-    _logger.warn('[%s:%d] %s', caller.function, caller.lineno, msg)
     _put(f_out, indent_level, '# ', msg)
 
+    if not _logger.isEnabledFor(WARN):
+        return  # e.g. --no-warnings, skip the caller lookup
 
-def convert(definitions, f_out, *,
-            import_from='*', indent_level=0, def_extras=(),
-            include_std_types=True):
-    global _last_anon_enum
+    try:
+        caller = _getframe(1)
+    except ValueError:
+        caller = None
 
-    if include_std_types:
+    if caller is not None and caller.f_globals is globals():
+        _logger.warning('[%s:%d] %s',
+                        caller.f_code.co_name, caller.f_lineno, msg)
+    else:
+        # compiled with Cython: the converters have no Python frames
+        _logger.warning('%s', msg)
+
+
+def _share_nodes(shared, pairs):
+    key = []
+    for name, value in pairs:
+        if type(value) is dict:
+            value = id(value),  # already shared, and kept alive by `shared`
+        elif type(value) is list:
+            return dict(pairs)
+        key.append((name, type(value), value))  # keep 1, 1.0 and True apart
+
+    key = tuple(key)
+    node = shared.get(key)
+    if node is None:
+        node = shared[key] = dict(pairs)
+    return node
+
+
+def _put_std_types(f_out, indent_level):
+    std_types = _std_types_cache.get(indent_level)
+    if std_types is None:
+        from textwrap import wrap
+
+        f_std_types = StringIO()
         for h_name, items in (('stddef', _STDDEF_TYPES),
                               ('stdint', _STDINT_TYPES)):
-            _put(f_out, indent_level, 'from libc.', h_name, ' cimport (')
+            _put(f_std_types, indent_level,
+                 'from libc.', h_name, ' cimport (')
             for line in wrap(', '.join(items), 79 - 4 * (indent_level + 1)):
-                _put(f_out, indent_level + 1, line)
-            _put(f_out, indent_level, ')')
+                _put(f_std_types, indent_level + 1, line)
+            _put(f_std_types, indent_level, ')')
 
-        _put(f_out, indent_level, 'cdef extern from *:')
-        _put(f_out, indent_level + 1, 'ctypedef bint _Bool')
+        _put(f_std_types, indent_level, 'cdef extern from *:')
+        _put(f_std_types, indent_level + 1, 'ctypedef bint _Bool')
 
-        _put(f_out, indent_level)
-        _put(f_out, indent_level)
+        _put(f_std_types, indent_level)
+        _put(f_std_types, indent_level)
 
-    _put(f_out, indent_level,
-         'cdef extern from ', import_from or '*', *def_extras, ':')
+        std_types = f_std_types.getvalue()
+        _std_types_cache[indent_level] = std_types
+
+    f_out.write(std_types)
+
+
+def _convert_definitions(ctx, definitions, indent_level, unknown_types):
+    # locals for the per-definition loop
+    convert_funs_get = _CONVERT_FUNS_GET
+    write = ctx.write
+    body_level = indent_level + 1
 
-    unknown_types = set()
     for definition in definitions:
-        if not isinstance(definition, dict):
+        if type(definition) is not dict:
             continue
 
         typ = definition.get('type')
@@ -860,19 +1020,121 @@ def convert(definitions, f_out, *,
             continue
 
         if typ != 'constant':
-            _last_anon_enum = None, None
+            ctx.anon_enum_name = ctx.anon_enum_fields = None
 
-        convert_fun = _CONVERT_FUNS.get(typ)
+        convert_fun = convert_funs_get(typ)
         if convert_fun:
-            if convert_fun(f_out, indent_level + 1, definition):
-                _put(f_out, 0)
+            if convert_fun(ctx, body_level, definition):
+                write('\n')
 
         elif typ not in unknown_types:
             unknown_types.add(typ)
-            _warn(f_out, indent_level, 'Unknown type=%r', typ)
+            _warn(ctx, indent_level, 'Unknown type=%r', typ)
+
+
+def _convert_chunk(chunk, indent_level):
+    definitions, unknown_types = chunk
+    ctx = _Ctx(StringIO())
+    ctx.emitted_at = []
+    _convert_definitions(ctx, definitions, indent_level, unknown_types)
+    return ctx.out.getvalue(), ctx.emitted_at
+
+
+def _init_worker(log_level, log_formatter):
+    # spawned workers do not inherit the logging setup of the parent
+    _logger.setLevel(log_level)
+    root_logger = getLogger()
+    if log_formatter and not root_logger.handlers:
+        handler = StreamHandler(stderr)
+        handler.setFormatter(log_formatter)
+        root_logger.addHandler(handler)
+
+
+def _split_definitions(definitions, chunk_count):
+    # Chunks only start at a definition that resets the anonymous enum
+    # state, and carry the unknown types already warned about, so that
+    # converting them separately gives the same text as one pass.
+    definitions = list(definitions)
+    chunk_size = max(1, len(definitions) // chunk_count)
+
+    chunks = []
+    chunk = []
+    chunk_unknown_types = set()
+    unknown_types = set()
+    for definition in definitions:
+        typ = definition.get('type') if type(definition) is dict else None
+        if typ and typ != 'constant' and len(chunk) >= chunk_size:
+            chunks.append((chunk, chunk_unknown_types))
+            chunk = []
+            chunk_unknown_types = set(unknown_types)
+
+        chunk.append(definition)
+        if typ and typ not in _CONVERT_FUNS:
+            unknown_types.add(typ)
+
+    if chunk:
+        chunks.append((chunk, chunk_unknown_types))
+    return chunks
+
+
+def render(definitions, *,
+           import_from='*', indent_level=0, def_extras=(),
+           include_std_types=True, jobs=1, cache_bases=True):
+    ctx = _Ctx(StringIO(), cache_bases)
+
+    if include_std_types:
+        _put_std_types(ctx, indent_level)
+
+    _put(ctx, indent_level,
+         'cdef extern from ', import_from or '*', *def_extras, ':')
+
+    if jobs == 1:
+        _convert_definitions(ctx, definitions, indent_level, set())
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+
+        jobs = jobs or cpu_count() or 1
+        root_handlers = getLogger().handlers
+        chunks = _split_definitions(definitions, 4 * jobs)
+        with ProcessPoolExecutor(
+            jobs,
+            initializer=_init_worker,
+            initargs=(_logger.getEffectiveLevel(),
+                      root_handlers[0].formatter if root_handlers else None),
+        ) as executor:
+            for text, emitted_at in executor.map(
+                partial(_convert_chunk, indent_level=indent_level),
+                chunks,
+            ):
+                # drop the lines an earlier chunk already emitted,
+                # each with the blank line that follows it
+                start = 0
+                for position, line in emitted_at:
+                    if line in ctx.emitted:
+                        ctx.write(text[start:position])
+                        start = text.index('\n', position) + 2
+                    else:
+                        ctx.emitted.add(line)
+                ctx.write(text[start:])
+
+    return ctx.out.getvalue()
+
+
+def convert(definitions, f_out, *,
+            import_from='*', indent_level=0, def_extras=(),
+            include_std_types=True, jobs=1):
+    # collect the whole output and hand it to the real file in one write
+    f_out.write(render(definitions,
+                       import_from=import_from,
+                       indent_level=indent_level,
+                       def_extras=def_extras,
+                       include_std_types=include_std_types,
+                       jobs=jobs))
 
 
 def gen_argv_parser(prog):
+    from argparse import ArgumentParser
+
     parser = ArgumentParser(prog=prog,
                             description='Convert C header to Cython .pxd file')
     parser.add_argument('input',
@@ -951,12 +1213,95 @@ def gen_argv_parser(prog):
                         const=ERROR,
                         dest='log_level',
                         help='Don\'t show warnings.')
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        default=1,
+                        dest='jobs',
+                        help='Number of processes converting definitions, '
+                             'default=1. "0" uses one per CPU. JSON input '
+                             'is only streamed with ijson when this is 1.')
+    parser.add_argument('--cache-dir',
+                        default=None,
+                        dest='cache_dir',
+                        help='Keep converted outputs in this directory, '
+                             'keyed by the JSON input and the options, and '
+                             'reuse them when the same JSON comes again.')
     return parser
 
 
+def _read_file(path):
+    fd = os_open(path, O_RDONLY)
+    try:
+        size = fstat(fd).st_size
+        if size:
+            data = read(fd, size)
+            if len(data) == size:
+                return data  # the common case: a single read() call
+            chunks = [data]
+        else:
+            chunks = []  # pipes and special files report no size
+
+        while True:
+            chunk = read(fd, 1 << 16)
+            if not chunk:
+                return b''.join(chunks)
+            chunks.append(chunk)
+    finally:
+        close(fd)
+
+
+def _cache_path(args, input_data):
+    from hashlib import blake2b
+
+    if type(input_data) is str:
+        input_data = input_data.encode('UTF-8')
+
+    key = blake2b(input_data)
+    key.update(repr((args.import_from, args.indent_level, args.use_gil,
+                     args.no_includes)).encode('UTF-8'))
+    with open(__file__, 'rb') as f_tool:
+        key.update(f_tool.read())
+
+    digest = key.hexdigest()
+    return join(args.cache_dir, digest[:2], digest[2:] + '.pxd')
+
+
+def _store_cached(cache_path, text):
+    try:
+        makedirs(dirname(cache_path), exist_ok=True)
+        tmp_path = '%s.%d' % (cache_path, getpid())
+        with open(tmp_path, 'w', encoding='UTF-8') as f_cache:
+            f_cache.write(text)
+        replace(tmp_path, cache_path)
+    except OSError:
+        pass  # the cache is only an optimization
+
+
+def _write_text(args, text, stdout):
+    with (open(args.output, args.write_mode)
+          if args.output else stdout) as f_out:
+        f_out.write(text)
+
+
+def _write_output(args, definitions, stdout, cache_path=None,
+                  cache_bases=True):
+    text = render(definitions,
+                  import_from=args.import_from,
+                  indent_level=args.indent_level,
+                  def_extras=(args.use_gil,),
+                  include_std_types=not args.no_includes,
+                  jobs=args.jobs,
+                  cache_bases=cache_bases)
+    if cache_path:
+        _store_cached(cache_path, text)
+    _write_text(args, text, stdout)
+
+
 def main(argv=argv, stdin=stdin, stdout=stdout):
     parser = gen_argv_parser(argv[0])
     args = parser.parse_args(argv[1:])
+    if args.jobs < 0:
+        parser.error('argument -j/--jobs: must not be negative')
 
     basicConfig(level=args.log_level, format='[%(levelname)s] %(message)s')
 
@@ -985,17 +1330,58 @@ def main(argv=argv, stdin=stdin, stdout=stdout):
         else:
             args.import_from = None
 
-    if not args.input:
-        input_data = stdin.read()
+    # the cache is keyed by the raw JSON, so it needs the buffered path;
+    # streamed nodes are never shared, so the base cache would only keep
+    # every definition alive
+    if (iter_json_items and not args.cache_dir and
+            args.input_type in ('json', 'auto')):
+        if args.input:
+            if args.input_type == 'json':
+                with open(args.input, 'rb') as in_f:
+                    _write_output(args, iter_json_items(in_f, 'item',
+                                                        use_float=True),
+                                  stdout, cache_bases=False)
+                return
+        else:
+            in_f = getattr(stdin, 'buffer', None)
+            # only buffered readers can sniff the input without consuming it
+            peek = getattr(in_f, 'peek', None)
+            if in_f is not None and (
+                args.input_type == 'json' or
+                peek is not None and peek(1).lstrip()[:1] == b'['
+            ):
+                args.input_type = 'json'
+                _write_output(args, iter_json_items(in_f, 'item',
+                                                    use_float=True),
+                              stdout, cache_bases=False)
+                return
+
+    if args.input_type == 'h' and args.input:
+        input_data = None  # ctypesgen gets the file itself as its stdin
+    elif not args.input:
+        input_data = getattr(stdin, 'buffer', stdin).read()
     else:
-        with open(args.input, 'rb') as in_f:
-            input_data = in_f.read()
-    input_data = input_data.lstrip()
+        input_data = _read_file(args.input)
 
     if args.input_type == 'auto':
-        args.input_type = 'json' if stdin[:1] == b'[' else 'h'
+        # find the first non-blank character without copying the input
+        start = 0
+        while input_data[start:start + 1].isspace():
+            start += 1
+        args.input_type = ('json' if input_data[start:start + 1] in ('[', b'[')
+                           else 'h')
 
     if args.input_type == 'h':
+        from subprocess import Popen, PIPE
+
+        # talk to ctypesgen in binary, there is no need to decode its output
+        if isinstance(input_data, str):
+            input_data = input_data.encode('UTF-8')
+
+        header_fd = None
+        if input_data is None:
+            header_fd = os_open(args.input, O_RDONLY)
+
         ctypesgen_process = None
         try:
             ctypesgen_process = Popen(
@@ -1003,10 +1389,9 @@ def main(argv=argv, stdin=stdin, stdout=stdout):
                  *args.ctypesgen_args,
                  '--output-language=json',
                  '/dev/stdin'],
-                stdin=PIPE,
+                stdin=PIPE if header_fd is None else header_fd,
                 stdout=PIPE,
                 stderr=PIPE if args.quiet_ctypesgen else stderr,
-                universal_newlines=isinstance(input_data, str),
             )
             input_data, error_log = ctypesgen_process.communicate(
                 input=input_data,
@@ -1014,25 +1399,41 @@ def main(argv=argv, stdin=stdin, stdout=stdout):
             )
             if ctypesgen_process.returncode != 0:
                 if args.quiet_ctypesgen:
-                    stderr.write(error_log)
+                    stderr.write(error_log.decode('UTF-8', 'replace'))
                 raise Exception('ctypesgen.py returned an error: %r',
                                 ctypesgen_process.returncode)
         finally:
             if ctypesgen_process:
                 ctypesgen_process.kill()
+            if header_fd is not None:
+                close(header_fd)
 
-    if isinstance(input_data, bytes):
-        input_data = input_data.decode('UTF-8')
+    cache_path = None
+    if args.cache_dir:
+        cache_path = _cache_path(args, input_data)
+        try:
+            cached = _read_file(cache_path)
+        except OSError:
+            pass
+        else:
+            _write_text(args, cached.decode('UTF-8'), stdout)
+            return
 
-    definitions = loads(input_data)
+    definitions = None
+    if fast_loads:
+        # orjson takes bytes as they are, but has no hook to share nodes
+        try:
+            definitions = fast_loads(input_data)
+        except JSONDecodeError:  # orjson's subclasses it
+            pass  # e.g. Infinity or integers wider than 64 bits
+    if definitions is None:
+        if isinstance(input_data, bytes):
+            input_data = input_data.decode('UTF-8')
 
-    with (open(args.output, args.write_mode)
-          if args.output else stdout) as f_out:
-        convert(definitions, f_out,
-                import_from=args.import_from,
-                indent_level=args.indent_level,
-                def_extras=(args.use_gil,),
-                include_std_types=not args.no_includes)
+        # let identical type nodes be one object, so the base cache can hit
+        definitions = loads(input_data,
+                            object_pairs_hook=partial(_share_nodes, {}))
+    _write_output(args, definitions, stdout, cache_path)
 
 
 _CONVERT_BASE_FUNS = {
@@ -1069,6 +1470,9 @@ _CONVERT_FUNS = {
     'variable': _convert_variable,
 }
 
+_CONVERT_TYPEDEF_FUNS_GET = _CONVERT_TYPEDEF_FUNS.get
+_CONVERT_FUNS_GET = _CONVERT_FUNS.get
+
 # Work around malloc.h oddities
 INCOMPLETE_STRUCT_TYPES = {'_IO_lock_t', '_IO_FILE_plus'}
 
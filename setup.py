@@ -0,0 +1,20 @@
+#!/usr/bin/env python3
+
+from setuptools import setup
+
+try:
+    from Cython.Build import cythonize
+except ImportError:
+    ext_modules = []  # the pure Python module works just the same
+else:
+    ext_modules = cythonize(['ctypesgen_to_pxd.py'], language_level=3)
+
+
+setup(
+    name='ctypesgen_to_pxd',
+    version='0.0.1',
+    description='Convert C header to Cython .pxd file',
+    license='Apache License, Version 2.0',
+    py_modules=['ctypesgen_to_pxd'],
+    ext_modules=ext_modules,
+)